@@ -1,11 +1,21 @@
 
-from typing import Any, Dict, List, Text
-
-import requests
+import asyncio
+import logging
+import os
+import re
+import sqlite3
+import time
+from typing import Any, Dict, List, Optional, Set, Text, Tuple
+from urllib.parse import urlencode
+
+import aiohttp
+import orjson
 from rasa_sdk import Action, Tracker
 from rasa_sdk.events import EventType, SlotSet
 from rasa_sdk.executor import CollectingDispatcher
 
+logger = logging.getLogger(__name__)
+
 # We use the medicare.gov database to find information about 3 different
 # healthcare facility types, given a city name, zip code or facility ID
 # the identifiers for each facility type is given by the medicare database
@@ -13,22 +23,25 @@ from rasa_sdk.executor import CollectingDispatcher
 # b27b-2uc7 is for nursing homes
 # 9wzi-peqs is for home health agencies
 
-ENDPOINTS = {
-    'base': 'https://data.medicare.gov/resource/{}.json',
+BASE_URL = 'https://data.medicare.gov/resource/{}.json'
+
+# any all-digit location is searched as a zip code, and ZIP+4 codes by their
+# first five digits
+ZIP_CODE_RE = re.compile(r'(\d{5})-\d{4}|\d+')
+
+# fields to filter on when searching each resource by city or zip code
+PARAM_FIELDS = {
     'xubh-q36u': {
-        'city_query': '?city={}',
-        'zip_code_query': '?zip_code={}',
-        'id_query': '?provider_id={}'
+        'city': 'city',
+        'zip': 'zip_code'
     },
     'b27b-2uc7': {
-        'city_query': '?provider_city={}',
-        'zip_code_query': '?provider_zip_code={}',
-        'id_query': '?federal_provider_number={}'
+        'city': 'provider_city',
+        'zip': 'provider_zip_code'
     },
     '9wzi-peqs': {
-        'city_query': '?city={}',
-        'zip_code_query': '?zip={}',
-        'id_query': '?provider_number={}'
+        'city': 'city',
+        'zip': 'zip'
     }
 }
 
@@ -47,42 +60,362 @@ FACILITY_TYPES = {
     }
 }
 
+RESOURCE_TO_NAME = {
+    value['resource']: value['name'] for value in FACILITY_TYPES.values()
+}
+
+FACILITY_RESOURCES = tuple(RESOURCE_TO_NAME)
 
-def _create_path(base: Text, resource: Text, query: Text, values: Text) -> Text:
-    """Creates a path to find provider using the endpoints."""
-    if isinstance(values, list):
-        return (base + query).format(
-            resource, ', '.join('"{0}"'.format(w) for w in values))
-    else:
-        return (base + query).format(resource, values)
+# fields holding the id and name of a facility in the response of each
+# resource, used to build the buttons of the search results
+BUTTON_FIELDS = {
+    'xubh-q36u': ('provider_id', 'hospital_name'),
+    'b27b-2uc7': ('federal_provider_number', 'provider_name'),
+    '9wzi-peqs': ('provider_number', 'provider_name')
+}
 
+# fields holding the address, city, state and zip code of a facility in the
+# response of each resource
+ADDRESS_FIELDS = {
+    'xubh-q36u': ('address', 'city', 'state', 'zip_code'),
+    'b27b-2uc7': (
+        'provider_address', 'provider_city', 'provider_state', 'provider_zip_code'
+    ),
+    '9wzi-peqs': ('address', 'city', 'state', 'zip')
+}
 
-def _find_facilities(location: Text, resource: Text) -> List[Dict]:
-    """Returns json of facilities matching the search criteria."""
 
-    if str.isdigit(location):
-        full_path = _create_path(
-            ENDPOINTS['base'], resource,
-            ENDPOINTS[resource]['zip_code_query'],
-            location
+def _inform_payload(**entities: Text) -> Text:
+    """Creates a button payload triggering the inform intent with the given
+    entities, json encoded so that quotes in their values are escaped."""
+    return '/inform' + orjson.dumps(entities).decode()
+
+
+# the facility types never change, so their buttons are built only once
+FACILITY_TYPE_BUTTONS = [
+    {
+        'title': value['name'].title(),
+        'payload': _inform_payload(facility_type=value['resource'])
+    }
+    for value in FACILITY_TYPES.values()
+]
+
+# limit number of results to 3 for clear presentation purposes
+MAX_RESULTS = 3
+
+# a single client session is shared by all actions so that connections to
+# data.medicare.gov are pooled and kept alive instead of going through a new
+# DNS lookup and TCP/TLS handshake on every request
+# The session lives as long as the action server process and is not closed
+# explicitly: the rasa_sdk server offers no shutdown hook to action modules,
+# and by the time atexit handlers run its event loop is already closed, so
+# closing it there would fail. The OS releases the sockets on exit, which
+# makes aiohttp's "Unclosed client session" warning at shutdown harmless.
+_SESSION: Optional[aiohttp.ClientSession] = None
+
+SESSION_HEADERS = {'User-Agent': 'rasa-masterclass-actions'}
+
+# a slow medicare.gov response must not stall the action for long, so every
+# request is bounded and retried with exponential backoff on transient errors
+REQUEST_TIMEOUT = aiohttp.ClientTimeout(total=15, connect=3, sock_read=10)
+RETRY_STATUSES = {429, 502, 503, 504}
+MAX_RETRIES = 3
+RETRY_BACKOFF = 0.5
+MAX_RETRY_DELAY = 10
+
+
+def _get_session() -> aiohttp.ClientSession:
+    """Returns the shared client session, creating it on first use."""
+    global _SESSION
+    # there is no await between the check and the assignment, so concurrent
+    # coroutines on the event loop can not create two sessions
+    if _SESSION is None or _SESSION.closed:
+        _SESSION = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit_per_host=50,
+                keepalive_timeout=60,
+                ttl_dns_cache=300
+            ),
+            headers=SESSION_HEADERS,
+            timeout=REQUEST_TIMEOUT
         )
+    return _SESSION
+
+
+class _TTLCache:
+    """Small cache whose entries expire after ``ttl`` seconds.
+
+    Entries are kept in memory and, when a ``path`` is given, also in a SQLite
+    database there, so they survive restarts of the action server. Database
+    errors are logged and the cache falls back to memory, so they never fail
+    a lookup.
+    """
+
+    def __init__(
+        self, name: Text, ttl: float, maxsize: int = 1024, path: Optional[Text] = None
+    ) -> None:
+        self.name = name
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.path = path
+        self._entries: Dict[Tuple[Text, ...], Tuple[float, Any]] = {}
+        self._connection: Optional[sqlite3.Connection] = None
+
+    def _db(self) -> Optional[sqlite3.Connection]:
+        """Returns the connection to the database, creating it on first use.
+
+        If the database can not be opened, persistence is turned off and None
+        is returned, so a failing database is not retried on every lookup.
+        """
+        if self._connection is None and self.path:
+            connection = None
+            try:
+                # the queries run on the event loop, so waiting on a lock held
+                # by another worker is kept short and writes are not synced
+                connection = sqlite3.connect(self.path, timeout=0.1)
+                connection.execute('PRAGMA synchronous = OFF')
+                connection.execute(
+                    'CREATE TABLE IF NOT EXISTS cache (name TEXT, key TEXT, '
+                    'expires_at REAL, value BLOB, PRIMARY KEY (name, key))'
+                )
+                with connection:
+                    connection.execute(
+                        'DELETE FROM cache WHERE expires_at < ?', (time.time(),)
+                    )
+            except sqlite3.Error as e:
+                if connection is not None:
+                    connection.close()
+                logger.warning(
+                    'Could not open the cache at %s, keeping it in memory only: %s',
+                    self.path, e
+                )
+                self.path = None
+                return None
+            self._connection = connection
+        return self._connection
+
+    def _load(self, key: Tuple[Text, ...]) -> Optional[Tuple[float, Any]]:
+        """Returns the unexpired entry stored in the database for key."""
+        connection = self._db()
+        if connection is None:
+            return None
+        try:
+            db_key = orjson.dumps(key).decode()
+            row = connection.execute(
+                'SELECT expires_at, value FROM cache WHERE name = ? AND key = ?',
+                (self.name, db_key)
+            ).fetchone()
+            if row is None:
+                return None
+            if row[0] < time.time():
+                with connection:
+                    connection.execute(
+                        'DELETE FROM cache WHERE name = ? AND key = ?',
+                        (self.name, db_key)
+                    )
+                return None
+            return row[0], orjson.loads(row[1])
+        except sqlite3.Error as e:
+            logger.warning('Could not read from the cache at %s: %s', self.path, e)
+            return None
+
+    def _store(self, key: Tuple[Text, ...], entry: Tuple[float, Any]) -> None:
+        """Writes an entry to the database."""
+        connection = self._db()
+        if connection is None:
+            return
+        try:
+            with connection:
+                connection.execute(
+                    'INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?)',
+                    (self.name, orjson.dumps(key).decode(), entry[0],
+                     orjson.dumps(entry[1]))
+                )
+        except sqlite3.Error as e:
+            logger.warning('Could not write to the cache at %s: %s', self.path, e)
+
+    def get(self, key: Tuple[Text, ...]) -> Any:
+        """Returns the cached value for key, or None if missing or expired."""
+        entry = self._entries.get(key)
+        if entry is None and self.path:
+            entry = self._load(key)
+            if entry is not None:
+                self._remember(key, entry)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at < time.time():
+            del self._entries[key]
+            return None
+        return value
+
+    def set(self, key: Tuple[Text, ...], value: Any) -> None:
+        """Stores value under key for the next ``ttl`` seconds."""
+        entry = (time.time() + self.ttl, value)
+        self._remember(key, entry)
+        if self.path:
+            self._store(key, entry)
+
+    def _remember(self, key: Tuple[Text, ...], entry: Tuple[float, Any]) -> None:
+        """Keeps an entry in memory, evicting the oldest one when full."""
+        if key not in self._entries and len(self._entries) >= self.maxsize:
+            del self._entries[next(iter(self._entries))]
+        self._entries[key] = entry
+
+
+# the medicare.gov datasets are updated at most daily, so search results can
+# be reused for an hour and facility addresses, which hardly ever change, for
+# a whole day. Set MEDICARE_CACHE_PATH to a file to also keep them in SQLite
+# across restarts
+CACHE_PATH = os.environ.get('MEDICARE_CACHE_PATH')
+_FACILITIES_CACHE = _TTLCache('facilities', ttl=3600, path=CACHE_PATH)
+_ADDRESS_CACHE = _TTLCache('address', ttl=86400, path=CACHE_PATH)
+
+
+def _retry_delay(response: aiohttp.ClientResponse, attempt: int) -> float:
+    """Returns how long to wait before retrying a failed request, honoring the
+    Retry-After header when the server sends one."""
+    retry_after = response.headers.get('Retry-After', '')
+    if retry_after.isdigit():
+        return min(float(retry_after), MAX_RETRY_DELAY)
+    return RETRY_BACKOFF * 2 ** attempt
+
+
+async def _get_json(full_path: Text) -> Any:
+    """Fetches the given path and returns its decoded json content."""
+    for attempt in range(MAX_RETRIES + 1):
+        try:
+            async with _get_session().get(full_path) as response:
+                if response.status in RETRY_STATUSES and attempt < MAX_RETRIES:
+                    delay = _retry_delay(response, attempt)
+                else:
+                    response.raise_for_status()
+                    return await response.json(loads=orjson.loads)
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+            if attempt == MAX_RETRIES:
+                raise
+            delay = RETRY_BACKOFF * 2 ** attempt
+        await asyncio.sleep(delay)
+
+
+def _build_url(resource: Text, params: Dict[Text, Text]) -> Text:
+    """Creates the url to query a resource, with percent-encoded parameters."""
+    return BASE_URL.format(resource) + '?' + urlencode(params, safe='$,')
+
+
+async def _find_facilities(location: Text, resource: Text) -> List[Dict]:
+    """Returns json of facilities matching the search criteria."""
+
+    zip_code = ZIP_CODE_RE.fullmatch(location)
+    if zip_code:
+        # the datasets only store the first five digits of ZIP+4 codes
+        field = PARAM_FIELDS[resource]['zip']
+        value = zip_code.group(1) or zip_code.group(0)
     else:
-        full_path = _create_path(
-            ENDPOINTS['base'], resource,
-            ENDPOINTS[resource]['city_query'],
-            location.upper()
-        )
-    # print("Full path:")
-    # print(full_path)
-    results = requests.get(full_path).json()
+        field, value = PARAM_FIELDS[resource]['city'], location.upper()
+
+    key = (resource, value)
+    results = _FACILITIES_CACHE.get(key)
+    if results is not None:
+        return results
+
+    params = {field: value}
+    # only the facilities and fields that are displayed are requested
+    params['$select'] = ','.join(BUTTON_FIELDS[resource])
+    params['$limit'] = str(MAX_RESULTS)
+    full_path = _build_url(resource, params)
+    results = await _get_json(full_path)
+    # empty results may come from a transient upstream issue, so they are
+    # fetched again next time instead of being cached
+    if results:
+        _FACILITIES_CACHE.set(key, results)
     return results
 
 
-def _resolve_name(facility_types, resource) -> Text:
-    for key, value in facility_types.items():
-        if value.get('resource') == resource:
-            return value.get('name')
-    return ''
+class _AutoBatcher:
+    """Coalesces facility lookups by ID issued within a short window into a
+    single request per facility type."""
+
+    def __init__(self, delay: float = 0.02) -> None:
+        self.delay = delay
+        self._pending: Dict[Text, Dict[Text, List[asyncio.Future]]] = {}
+        # references to the running flush tasks, so they are not garbage
+        # collected before they finish
+        self._tasks: Set[asyncio.Future] = set()
+
+    async def lookup(self, resource: Text, facility_id: Text) -> List[Dict]:
+        """Returns json of the facilities of the given type and ID."""
+        if resource not in BUTTON_FIELDS:
+            raise KeyError(resource)
+        future = asyncio.get_event_loop().create_future()
+        pending = self._pending.get(resource)
+        if pending is None:
+            pending = self._pending[resource] = {}
+            task = asyncio.ensure_future(self._flush(resource))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        pending.setdefault(facility_id, []).append(future)
+        return await future
+
+    async def _flush(self, resource: Text) -> None:
+        """Fetches all IDs collected during the window and resolves their
+        lookups."""
+        pending: Dict[Text, List[asyncio.Future]] = {}
+        try:
+            await asyncio.sleep(self.delay)
+            pending = self._pending.pop(resource)
+            # SoQL string literals are single quoted, with quotes escaped by
+            # doubling
+            ids = ', '.join(
+                "'{}'".format(facility_id.replace("'", "''"))
+                for facility_id in pending
+            )
+            id_field = BUTTON_FIELDS[resource][0]
+            full_path = _build_url(resource, {
+                '$where': '{} in ({})'.format(id_field, ids),
+                '$select': ','.join((id_field,) + ADDRESS_FIELDS[resource])
+            })
+            rows = await _get_json(full_path)
+
+            found: Dict[Text, List[Dict]] = {}
+            for row in rows:
+                found.setdefault(row.get(id_field), []).append(row)
+            for facility_id, futures in pending.items():
+                for future in futures:
+                    if not future.done():
+                        future.set_result(found.get(facility_id, []))
+        except asyncio.CancelledError:
+            pending = pending or self._pending.pop(resource, {})
+            for futures in pending.values():
+                for future in futures:
+                    future.cancel()
+            raise
+        except Exception as e:
+            pending = pending or self._pending.pop(resource, {})
+            for futures in pending.values():
+                for future in futures:
+                    if not future.done():
+                        future.set_exception(e)
+
+
+_ADDRESS_BATCHER = _AutoBatcher()
+
+
+async def _find_other_types(location: Text, resource: Text) -> Dict[Text, List[Dict]]:
+    """Returns facilities of every type but the given one matching the
+    location, by resource. Types whose lookup failed are left out."""
+    resources = [other for other in FACILITY_RESOURCES if other != resource]
+    results = await asyncio.gather(
+        *(_find_facilities(location, other) for other in resources),
+        return_exceptions=True
+    )
+    found = {}
+    for other, result in zip(resources, results):
+        if isinstance(result, BaseException):
+            logger.warning('Could not search for %s in %s: %r', other, location, result)
+        else:
+            found[other] = result
+    return found
 
 
 class FindFacilityTypes(Action):
@@ -100,18 +433,7 @@ class FindFacilityTypes(Action):
         domain: Dict[Text, Any]
     ) -> List:
 
-        buttons = []
-        for t in FACILITY_TYPES:
-            facility_type = FACILITY_TYPES[t]
-            payload = "/inform{\"facility_type\": \"" + facility_type.get(
-                'resource') + "\"}"
-
-            buttons.append({
-                'title': '{}'.format(facility_type.get('name').title()),
-                'payload': payload
-            })
-
-        dispatcher.utter_message('utter_greet', buttons=buttons)
+        dispatcher.utter_message('utter_greet', buttons=FACILITY_TYPE_BUTTONS)
         return []
 
 
@@ -123,7 +445,7 @@ class FindHealthCareAddress(Action):
         """Unique identifier of the action"""
         return 'find_healthcare_address'
 
-    def run(
+    async def run(
         self,
         dispatcher: CollectingDispatcher,
         tracker: Tracker,
@@ -132,43 +454,33 @@ class FindHealthCareAddress(Action):
 
         facility_type = tracker.get_slot('facility_type')
         healthcare_id = tracker.get_slot('facility_id')
-        full_path = _create_path(
-            ENDPOINTS['base'], facility_type,
-            ENDPOINTS[facility_type]['id_query'],
-            healthcare_id
-        )
-        results = requests.get(full_path).json()
+        key = (facility_type, healthcare_id)
+        results = _ADDRESS_CACHE.get(key)
+        if results is None and healthcare_id is not None:
+            results = await _ADDRESS_BATCHER.lookup(facility_type, healthcare_id)
+            if results:
+                _ADDRESS_CACHE.set(key, results)
         if results:
             selected = results[0]
-            if facility_type == FACILITY_TYPES['hospital']['resource']:
-                address = '{}, {}, {} {}'.format(
-                    selected['address'].title(),
-                    selected['city'].title(),
-                    selected['state'].upper(),
-                    selected['zip_code'].title()
-                )
-            elif facility_type == FACILITY_TYPES['nursing_home']['resource']:
-                address = '{}, {}, {} {}'.format(
-                    selected['provider_address'].title(),
-                    selected['provider_city'].title(),
-                    selected['provider_state'].upper(),
-                    selected['provider_zip_code'].title()
-                )
-            else:
-                address = '{}, {}, {} {}'.format(
-                    selected['address'].title(),
-                    selected['city'].title(),
-                    selected['state'].upper(),
-                    selected['zip'].title()
-                )
+            address_field, city_field, state_field, zip_field = (
+                ADDRESS_FIELDS[facility_type]
+            )
+            address = '{}, {}, {} {}'.format(
+                selected[address_field].title(),
+                selected[city_field].title(),
+                selected[state_field].upper(),
+                selected[zip_field].title()
+            )
 
             return [SlotSet('facility_address', address)]
         else:
-            print('No address found. Most likely this action was executed '
-                  'before the user choose a healthcare facility from the '
-                  'provided list. '
-                  'If this is a common problem in your dialogue flow,'
-                  'using a form instead for this action might be appropriate.')
+            logger.warning(
+                'No address found. Most likely this action was executed '
+                'before the user choose a healthcare facility from the '
+                'provided list. '
+                'If this is a common problem in your dialogue flow, '
+                'using a form instead for this action might be appropriate.'
+            )
 
             return [SlotSet('facility_address', 'not found')]
 
@@ -203,7 +515,7 @@ class SubmitFacilityForm(Action):
         """Unique identifier of the action"""
         return 'submit_facility_form'
 
-    def run(
+    async def run(
         self, dispatcher: CollectingDispatcher, tracker: Tracker, domain: Dict
     ) -> List[EventType]:
         """Once required slots are filled, print buttons for found facilities"""
@@ -211,32 +523,35 @@ class SubmitFacilityForm(Action):
         location = tracker.get_slot('location')
         facility_type = tracker.get_slot('facility_type')
 
-        results = _find_facilities(location, facility_type)
-        button_name = _resolve_name(FACILITY_TYPES, facility_type)
+        results = await _find_facilities(location, facility_type)
+        button_name = RESOURCE_TO_NAME.get(facility_type, '')
         if len(results) == 0:
-            dispatcher.utter_message(
-                'Sorry, we could not find a {} in {}.'.format(
-                    button_name, location.title()
-                )
+            message = 'Sorry, we could not find a {} in {}.'.format(
+                button_name, location.title()
             )
+            # the other facility types are probed concurrently, so telling the
+            # user what else exists there costs a single round-trip
+            others = await _find_other_types(location, facility_type)
+            available = [
+                RESOURCE_TO_NAME[resource]
+                for resource, found in others.items()
+                if found
+            ]
+            if available:
+                message += ' We did find: {}.'.format(', '.join(available))
+            dispatcher.utter_message(message)
             return []
 
         buttons = []
-        # limit number of results to 3 for clear presentation purposes
-        for r in results[:3]:
-            if facility_type == FACILITY_TYPES['hospital']['resource']:
-                facility_id = r.get('provider_id')
-                name = r['hospital_name']
-            elif facility_type == FACILITY_TYPES['nursing_home']['resource']:
-                facility_id = r['federal_provider_number']
-                name = r['provider_name']
-            else:
-                facility_id = r['provider_number']
-                name = r['provider_name']
-
-            payload = "/inform{\"facility_id\":\"" + facility_id + "\"}"
-            buttons.append(
-                {'title': '{}'.format(name.title()), 'payload': payload})
+        id_field, name_field = BUTTON_FIELDS[facility_type]
+        for r in results[:MAX_RESULTS]:
+            facility_id = r[id_field]
+            name = r[name_field]
+
+            buttons.append({
+                'title': name.title(),
+                'payload': _inform_payload(facility_id=facility_id)
+            })
 
         if len(buttons) == 1:
             message = 'Here is a {} near you:'.format(button_name)
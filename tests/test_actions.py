@@ -0,0 +1,420 @@
+import asyncio
+import sqlite3
+
+import aiohttp
+import pytest
+
+from actions import actions
+
+
+@pytest.fixture(autouse=True)
+def empty_caches(monkeypatch):
+    """Gives every test fresh in-memory facilities and address caches."""
+    monkeypatch.setattr(
+        actions, '_FACILITIES_CACHE', actions._TTLCache('facilities', ttl=3600)
+    )
+    monkeypatch.setattr(
+        actions, '_ADDRESS_CACHE', actions._TTLCache('address', ttl=86400)
+    )
+
+
+@pytest.fixture
+def fetched(monkeypatch):
+    """Replaces _get_json with a stub returning one hospital per requested
+    path, and collects the requested paths."""
+    paths = []
+
+    async def get_json(full_path):
+        paths.append(full_path)
+        return [{
+            'provider_id': '1',
+            'address': '1 main st',
+            'city': 'boston',
+            'state': 'ma',
+            'zip_code': '02101'
+        }]
+
+    monkeypatch.setattr(actions, '_get_json', get_json)
+    return paths
+
+
+@pytest.mark.asyncio
+async def test_batcher_coalesces_lookups_into_one_request(fetched):
+    batcher = actions._AutoBatcher(delay=0.01)
+    first, second, third = await asyncio.gather(
+        batcher.lookup('xubh-q36u', '1'),
+        batcher.lookup('xubh-q36u', '2'),
+        batcher.lookup('xubh-q36u', '1')
+    )
+
+    assert len(fetched) == 1
+    assert "provider_id+in+%28%271%27,+%272%27%29" in fetched[0]
+    assert first == third == [{
+        'provider_id': '1',
+        'address': '1 main st',
+        'city': 'boston',
+        'state': 'ma',
+        'zip_code': '02101'
+    }]
+    assert second == []
+
+
+@pytest.mark.asyncio
+async def test_batcher_sends_one_request_per_resource(fetched):
+    batcher = actions._AutoBatcher(delay=0.01)
+    await asyncio.gather(
+        batcher.lookup('xubh-q36u', '1'),
+        batcher.lookup('b27b-2uc7', '1')
+    )
+
+    assert len(fetched) == 2
+
+
+@pytest.mark.asyncio
+async def test_batcher_sets_errors_on_every_lookup(monkeypatch):
+    async def get_json(full_path):
+        raise RuntimeError('medicare.gov is down')
+
+    monkeypatch.setattr(actions, '_get_json', get_json)
+    batcher = actions._AutoBatcher(delay=0.01)
+    results = await asyncio.gather(
+        batcher.lookup('xubh-q36u', '1'),
+        batcher.lookup('xubh-q36u', '2'),
+        return_exceptions=True
+    )
+
+    assert [str(r) for r in results] == ['medicare.gov is down'] * 2
+    assert not batcher._pending
+    assert not batcher._tasks
+
+
+@pytest.mark.asyncio
+async def test_batcher_rejects_unknown_resource(fetched):
+    batcher = actions._AutoBatcher(delay=0.01)
+    with pytest.raises(KeyError):
+        await asyncio.wait_for(batcher.lookup(None, '1'), timeout=1)
+
+    assert not fetched
+    assert not batcher._pending
+
+
+class FakeResponse:
+    """Response of FakeSession with the given status and headers."""
+
+    def __init__(self, status, headers=None):
+        self.status = status
+        self.headers = headers or {}
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+    def raise_for_status(self):
+        if self.status >= 400:
+            raise aiohttp.ClientResponseError(
+                None, (), status=self.status, message='error'
+            )
+
+    async def json(self, loads):
+        return loads(b'[{"provider_id": "1"}]')
+
+
+class FakeSession:
+    """Client session returning the given responses, or raising the given
+    exceptions, one per request."""
+
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.requests = 0
+
+    def get(self, full_path):
+        self.requests += 1
+        response = self.responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+
+@pytest.fixture
+def delays(monkeypatch):
+    """Makes asyncio.sleep return immediately and collects its delays."""
+    slept = []
+
+    async def sleep(delay):
+        slept.append(delay)
+
+    monkeypatch.setattr(actions.asyncio, 'sleep', sleep)
+    return slept
+
+
+@pytest.mark.asyncio
+async def test_get_json_retries_on_retry_status(monkeypatch, delays):
+    session = FakeSession(FakeResponse(503), FakeResponse(502), FakeResponse(200))
+    monkeypatch.setattr(actions, '_get_session', lambda: session)
+
+    assert await actions._get_json('url') == [{'provider_id': '1'}]
+    assert session.requests == 3
+    assert delays == [0.5, 1.0]
+
+
+@pytest.mark.asyncio
+async def test_get_json_honors_retry_after(monkeypatch, delays):
+    session = FakeSession(
+        FakeResponse(429, {'Retry-After': '2'}),
+        FakeResponse(429, {'Retry-After': '120'}),
+        FakeResponse(200)
+    )
+    monkeypatch.setattr(actions, '_get_session', lambda: session)
+
+    await actions._get_json('url')
+    assert delays == [2, actions.MAX_RETRY_DELAY]
+
+
+@pytest.mark.asyncio
+async def test_get_json_raises_error_status_after_last_attempt(monkeypatch, delays):
+    session = FakeSession(*[FakeResponse(503)] * (actions.MAX_RETRIES + 1))
+    monkeypatch.setattr(actions, '_get_session', lambda: session)
+
+    with pytest.raises(aiohttp.ClientResponseError):
+        await actions._get_json('url')
+    assert session.requests == actions.MAX_RETRIES + 1
+
+
+@pytest.mark.asyncio
+async def test_get_json_raises_connection_error_after_last_attempt(
+    monkeypatch, delays
+):
+    session = FakeSession(
+        *[aiohttp.ClientConnectionError()] * (actions.MAX_RETRIES + 1)
+    )
+    monkeypatch.setattr(actions, '_get_session', lambda: session)
+
+    with pytest.raises(aiohttp.ClientConnectionError):
+        await actions._get_json('url')
+    assert session.requests == actions.MAX_RETRIES + 1
+    assert delays == [0.5, 1.0, 2.0]
+
+
+@pytest.mark.asyncio
+async def test_get_json_does_not_retry_other_errors(monkeypatch, delays):
+    session = FakeSession(FakeResponse(404))
+    monkeypatch.setattr(actions, '_get_session', lambda: session)
+
+    with pytest.raises(aiohttp.ClientResponseError):
+        await actions._get_json('url')
+    assert session.requests == 1
+    assert not delays
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Replaces time.time with a clock that only moves when told to."""
+    now = [1000.0]
+    monkeypatch.setattr(actions.time, 'time', lambda: now[0])
+    return now
+
+
+def test_cache_expires_entries(clock):
+    cache = actions._TTLCache('test', ttl=10)
+    cache.set(('key',), [1])
+
+    clock[0] += 9
+    assert cache.get(('key',)) == [1]
+    clock[0] += 2
+    assert cache.get(('key',)) is None
+
+
+def test_cache_evicts_oldest_entry_when_full(clock):
+    cache = actions._TTLCache('test', ttl=10, maxsize=2)
+    cache.set(('a',), [1])
+    cache.set(('b',), [2])
+    cache.set(('c',), [3])
+
+    assert cache.get(('a',)) is None
+    assert cache.get(('b',)) == [2]
+    assert cache.get(('c',)) == [3]
+
+
+def test_cache_reloads_entries_from_sqlite(clock, tmp_path):
+    path = str(tmp_path / 'cache.sqlite')
+    actions._TTLCache('test', ttl=10, path=path).set(('key',), [{'id': '1'}])
+
+    assert actions._TTLCache('test', ttl=10, path=path).get(('key',)) == [
+        {'id': '1'}
+    ]
+    assert actions._TTLCache('other', ttl=10, path=path).get(('key',)) is None
+
+
+def test_cache_deletes_expired_sqlite_entries(clock, tmp_path):
+    path = str(tmp_path / 'cache.sqlite')
+    actions._TTLCache('test', ttl=10, path=path).set(('key',), [1])
+    cache = actions._TTLCache('test', ttl=10, path=path)
+    cache._db()
+
+    clock[0] += 11
+    assert cache.get(('key',)) is None
+    assert not cache._entries
+    count = cache._db().execute('SELECT COUNT(*) FROM cache').fetchone()[0]
+    assert count == 0
+
+
+def test_cache_falls_back_to_memory_on_sqlite_errors(clock, tmp_path):
+    cache = actions._TTLCache('test', ttl=10, path=str(tmp_path))
+    cache.set(('key',), [1])
+
+    assert cache.get(('key',)) == [1]
+    assert cache.get(('other',)) is None
+
+
+def test_cache_stops_using_a_database_that_fails_to_open(monkeypatch, tmp_path):
+    connections = []
+
+    class LockedConnection:
+        closed = False
+
+        def execute(self, *args):
+            raise sqlite3.OperationalError('database is locked')
+
+        def close(self):
+            self.closed = True
+
+    def connect(*args, **kwargs):
+        connections.append(LockedConnection())
+        return connections[-1]
+
+    monkeypatch.setattr(actions.sqlite3, 'connect', connect)
+    cache = actions._TTLCache('test', ttl=10, path=str(tmp_path / 'cache.sqlite'))
+    cache.set(('key',), [1])
+    cache._entries.clear()
+
+    assert cache.get(('key',)) is None
+    assert cache.get(('other',)) is None
+    assert len(connections) == 1
+    assert connections[0].closed
+
+
+class FakeTracker:
+    """Tracker holding the given slots."""
+
+    def __init__(self, **slots):
+        self.slots = slots
+
+    def get_slot(self, name):
+        return self.slots.get(name)
+
+
+class FakeDispatcher:
+    """Dispatcher collecting the messages sent to the user."""
+
+    def __init__(self):
+        self.messages = []
+
+    def utter_message(self, text, **kwargs):
+        self.messages.append(text)
+
+
+@pytest.fixture
+def found_types(monkeypatch):
+    """Replaces _get_json with a stub finding a facility only for the
+    resources in the returned set, and failing for those in its ``failing``
+    attribute. The requested resources are collected in ``requested``."""
+
+    class Found(set):
+        failing = set()
+        requested = []
+
+    found = Found()
+
+    async def get_json(full_path):
+        resource = full_path.split('/resource/')[1].split('.json')[0]
+        found.requested.append(resource)
+        if resource in found.failing:
+            raise RuntimeError('medicare.gov is down')
+        if resource in found:
+            return [dict.fromkeys(actions.BUTTON_FIELDS[resource], 'x')]
+        return []
+
+    monkeypatch.setattr(actions, '_get_json', get_json)
+    return found
+
+
+@pytest.mark.asyncio
+async def test_submit_lists_other_types_found_when_none_of_the_type(found_types):
+    found_types.add('b27b-2uc7')
+    dispatcher = FakeDispatcher()
+    tracker = FakeTracker(location='boston', facility_type='xubh-q36u')
+
+    await actions.SubmitFacilityForm().run(dispatcher, tracker, {})
+
+    assert dispatcher.messages == [
+        'Sorry, we could not find a hospital in Boston. We did find: nursing home.'
+    ]
+    assert sorted(found_types.requested) == ['9wzi-peqs', 'b27b-2uc7', 'xubh-q36u']
+
+
+@pytest.mark.asyncio
+async def test_submit_replies_when_probing_other_types_fails(found_types):
+    found_types.add('b27b-2uc7')
+    found_types.failing.add('9wzi-peqs')
+    dispatcher = FakeDispatcher()
+    tracker = FakeTracker(location='boston', facility_type='xubh-q36u')
+
+    await actions.SubmitFacilityForm().run(dispatcher, tracker, {})
+
+    assert dispatcher.messages == [
+        'Sorry, we could not find a hospital in Boston. We did find: nursing home.'
+    ]
+
+
+@pytest.mark.asyncio
+async def test_submit_replies_when_no_type_is_found(found_types):
+    dispatcher = FakeDispatcher()
+    tracker = FakeTracker(location='boston', facility_type='xubh-q36u')
+
+    await actions.SubmitFacilityForm().run(dispatcher, tracker, {})
+
+    assert dispatcher.messages == ['Sorry, we could not find a hospital in Boston.']
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize('location, query', [
+    ('10001', 'zip_code=10001&'),
+    ('10001-1234', 'zip_code=10001&'),
+    ('1234', 'zip_code=1234&'),
+    ('boston', 'city=BOSTON&')
+])
+async def test_find_facilities_searches_zip_codes_and_cities(
+    fetched, location, query
+):
+    await actions._find_facilities(location, 'xubh-q36u')
+
+    assert fetched == [
+        'https://data.medicare.gov/resource/xubh-q36u.json?' + query
+        + '$select=provider_id,hospital_name&$limit=3'
+    ]
+
+
+def test_build_url_encodes_values_and_keeps_soql_parameters():
+    url = actions._build_url('xubh-q36u', {
+        'city': 'NEW YORK',
+        '$select': 'provider_id,hospital_name',
+        '$limit': '3'
+    })
+
+    assert url == (
+        'https://data.medicare.gov/resource/xubh-q36u.json'
+        '?city=NEW+YORK&$select=provider_id,hospital_name&$limit=3'
+    )
+
+
+@pytest.mark.asyncio
+async def test_find_facilities_encodes_city_names(fetched):
+    await actions._find_facilities('new york', 'b27b-2uc7')
+
+    assert fetched == [
+        'https://data.medicare.gov/resource/b27b-2uc7.json'
+        '?provider_city=NEW+YORK'
+        '&$select=federal_provider_number,provider_name&$limit=3'
+    ]